@@ -7,26 +7,38 @@
 from sqlite3 import dbapi2 as sqlite
 import ConfigParser
 import Queue
+import cPickle
 import datetime
+import heapq
 import logging
 import logging.config
 import nntplib
 import os
 import re
 import signal
+import socket
 import sys
 import threading
 import time
 import traceback
+import zlib
 
 # My pidlock
 import pidlock
 
 # Configuration defaults
 CONF_DEFAULTS={'port':'119', 'newsdb':'newsdb', 'pidfile':'nntpsucka.pid',
-    'shouldMarkArticles': 'true', 'maxArticles': 0}
+    'shouldMarkArticles': 'true', 'maxArticles': 0, 'processes': '1',
+    'connectParallelism': '4', 'bytesPerSecond': '0',
+    'commandsPerSecond': '0', 'retryAttempts': '5', 'retryBackoff': '3600',
+    'timeout': '60'}
 CONF_SECTIONS=['misc', 'servers']
 
+# How long do we wait for startup?
+STARTUP_TIMEOUT = 30
+# And how long will we wait for the actual processing?
+TIMEOUT = 4 * 3600
+
 class Stats:
     """Keep statistics describing what got moved."""
 
@@ -34,9 +46,19 @@ class Stats:
         self.moved=0
         self.dup=0
         self.other=0
-
-    def addMoved(self):
-        """Mark one article copied."""
+        self.crosspost=0
+        self.deferred=0
+        self.recovered=0
+        self.abandoned=0
+        self.firstMoved=None
+        self.shaperWait={}
+
+    def addMoved(self, when=None):
+        """Mark one article copied (at the time when, defaulting to now)."""
+        if when is None:
+            when=time.time()
+        if self.firstMoved is None or when < self.firstMoved:
+            self.firstMoved=when
         self.moved+=1
 
     def addDup(self):
@@ -47,10 +69,154 @@ class Stats:
         """Mark one article not copied, but not duplicate."""
         self.other+=1
 
+    def addCrosspost(self):
+        """Mark one article skipped because it was already in flight from
+        another group."""
+        self.crosspost+=1
+
+    def addDeferred(self):
+        """Mark one article put off to be retried later."""
+        self.deferred+=1
+
+    def addRecovered(self):
+        """Mark one article copied on a retry."""
+        self.recovered+=1
+
+    def addAbandoned(self):
+        """Mark one article given up on after too many retries."""
+        self.abandoned+=1
+
+    def addShaperWait(self, server, secs):
+        """Record time spent waiting on the given server's shaper."""
+        self.shaperWait[server]=self.shaperWait.get(server, 0) + secs
+
+    def merge(self, other):
+        """Add in the counts from another Stats (e.g. from a shard)."""
+        self.moved+=other.moved
+        self.dup+=other.dup
+        self.other+=other.other
+        self.crosspost+=other.crosspost
+        self.deferred+=other.deferred
+        self.recovered+=other.recovered
+        self.abandoned+=other.abandoned
+        if self.firstMoved is None or (other.firstMoved is not None
+            and other.firstMoved < self.firstMoved):
+            self.firstMoved=other.firstMoved
+        for server, secs in other.shaperWait.items():
+            self.addShaperWait(server, secs)
+
     def __str__(self):
         return "Moved:  " + str(self.moved) \
             + ", duplicate:  " + str(self.dup) \
-            + ", Other:  " + str(self.other)
+            + ", Other:  " + str(self.other) \
+            + ", crosspost:  " + str(self.crosspost)
+
+    def retryString(self):
+        """Describe what happened with retries."""
+        return "Deferred:  " + str(self.deferred) \
+            + ", recovered:  " + str(self.recovered) \
+            + ", gave up:  " + str(self.abandoned)
+
+######################################################################
+
+class InFlight:
+    """Registry of articles that are currently queued or being copied, keyed
+    by (destination, message ID).
+
+    A crossposted article shows up in every group it was posted to, but it
+    only needs to be transferred once.
+
+    If a (shared) NewsDB is given, the registry is kept there so it covers
+    every shard process, since a crossposted article's groups usually
+    belong to different shards."""
+
+    def __init__(self, db=None):
+        self.lock=threading.Lock()
+        self.ids={}
+        self.db=db
+
+    def claimAll(self, keys):
+        """Claim as many of the given keys as possible, returning a dict of
+        the ones we got (the rest are already in flight)."""
+        self.lock.acquire()
+        try:
+            rv={}
+            for key in keys:
+                if key not in self.ids:
+                    rv[key]=1
+            if self.db is not None and rv:
+                rv=self.db.claimInFlight(rv.keys(), os.getpid())
+            self.ids.update(rv)
+            return rv
+        finally:
+            self.lock.release()
+
+    def releaseAll(self, keys):
+        """Release keys once their transfers are finished, one way or
+        another."""
+        self.lock.acquire()
+        try:
+            for key in keys:
+                self.ids.pop(key, None)
+            if self.db is not None and keys:
+                self.db.releaseInFlight(keys)
+        finally:
+            self.lock.release()
+
+class Progress:
+    """How far through each group each destination has safely got.
+
+    An article queued for a destination is outstanding until its result
+    comes back.  The last seen ID must never move past an outstanding
+    article, or it would be skipped for good if the run dies first."""
+
+    def __init__(self):
+        # (group, dest) -> [highest scanned, heap of outstanding numbers,
+        #                   outstanding numbers, last ID reported]
+        self.groups={}
+
+    def __get(self, group, dest):
+        k=(group, dest)
+        if k not in self.groups:
+            self.groups[k]=[0, [], {}, None]
+        return self.groups[k]
+
+    def scanned(self, group, dest, num):
+        """Note that the article has been looked at for dest."""
+        g=self.__get(group, dest)
+        g[0]=max(g[0], num)
+
+    def add(self, group, dest, num):
+        """Note that the article has been queued for dest."""
+        g=self.__get(group, dest)
+        if num not in g[2]:
+            g[2][num]=1
+            heapq.heappush(g[1], num)
+
+    def finish(self, group, dest, num):
+        """Note that the article's result for dest is in (ignored if it
+        wasn't added)."""
+        g=self.groups.get((group, dest))
+        if g is not None:
+            g[2].pop(num, None)
+
+    def lastId(self, group, dest):
+        """Get the ID that's now safe to record as last seen, or None if
+        it hasn't changed since the last call."""
+        g=self.groups.get((group, dest))
+        if g is None:
+            return None
+        heap, outstanding = g[1], g[2]
+        while heap and heap[0] not in outstanding:
+            heapq.heappop(heap)
+        if heap:
+            rv=min(heap[0] - 1, g[0])
+        else:
+            rv=g[0]
+        if rv == g[3]:
+            return None
+        g[3]=rv
+        return rv
 
 ######################################################################
 
@@ -64,12 +230,63 @@ create table if not exists groups (
     group_name varchar(256) primary key,
     last_id int
 );
+
+create table if not exists dest_articles (
+    dest varchar(256),
+    messid varchar(256),
+    ts timestamp,
+    primary key (dest, messid)
+);
+
+create table if not exists dest_groups (
+    dest varchar(256),
+    group_name varchar(256),
+    last_id int,
+    primary key (dest, group_name)
+);
+
+create table if not exists retries (
+    dest varchar(256),
+    messid varchar(256),
+    group_name varchar(256),
+    article_num int,
+    attempts int,
+    next_try real,
+    primary key (dest, messid)
+);
+"""
+
+RESETINFLIGHTSCRIPT="""
+drop table if exists inflight;
+
+create table inflight (
+    dest varchar(256),
+    messid varchar(256),
+    owner int,
+    primary key (dest, messid)
+);
+
+create index inflight_owner on inflight (owner);
 """
 
 INS_ARTICLE="""insert or replace into articles values(?, ?)"""
 GET_ARTICLE="""select * from articles where messid = ?"""
 INS_GROUP="""insert or replace into groups values (?, ?)"""
 GET_GROUP="""select * from groups where group_name = ?"""
+INS_DEST_ARTICLE="""insert or replace into dest_articles values(?, ?, ?)"""
+GET_DEST_ARTICLE="""select * from dest_articles
+    where dest = ? and messid = ?"""
+INS_DEST_GROUP="""insert or replace into dest_groups values (?, ?, ?)"""
+GET_DEST_GROUP="""select last_id from dest_groups
+    where dest = ? and group_name = ?"""
+INS_RETRY="""insert or replace into retries values (?, ?, ?, ?, ?, ?)"""
+GET_RETRY="""select attempts from retries where dest = ? and messid = ?"""
+DEL_RETRY="""delete from retries where dest = ? and messid = ?"""
+GET_DUE_RETRIES="""select dest, messid, group_name, article_num from retries
+    where next_try <= ? order by next_try"""
+INS_INFLIGHT="""insert or ignore into inflight values (?, ?, ?)"""
+GET_INFLIGHT="""select dest, messid from inflight where owner = ?"""
+DEL_INFLIGHT="""delete from inflight where dest = ? and messid = ?"""
 
 class NewsDB:
     """Database of seen articles and groups.
@@ -82,12 +299,35 @@ class NewsDB:
 
     Group entries (l) have a string value that represents that last seen
     article by number for the given group (the part after the l/).
+
+    Articles and groups are tracked separately for each destination.  The
+    primary destination (dest '') uses the original tables, so existing
+    databases carry on where they left off; any others are keyed by name.
+
+    Articles that couldn't be copied for now are kept in the retries table
+    along with how many times they've been tried and when they may next be
+    tried.
     """
 
     __TXN_SIZE = 100
+    __BUSY_TIMEOUT = 120
 
-    def __init__(self, dbpath):
-        self.db = sqlite.connect(dbpath)
+    def __init__(self, dbpath, shared=False):
+        """Open the news DB at dbpath.
+
+        If shared is true, several processes will be writing to this DB at
+        once, so it's put in WAL mode and writers wait for each other.
+        Whoever's using a shared DB should commit() before doing anything
+        that might block, so they don't hold the write lock meanwhile.
+        """
+        if shared:
+            self.db = sqlite.connect(dbpath, timeout=self.__BUSY_TIMEOUT)
+            self.db.execute("pragma journal_mode=wal")
+            # WAL is still consistent across a crash at NORMAL, and it
+            # saves an fsync per commit.
+            self.db.execute("pragma synchronous=normal")
+        else:
+            self.db = sqlite.connect(dbpath)
         self.cur = self.db.cursor()
         self.cur.executescript(DBINITSCRIPT)
         self.log = logging.getLogger("NewsDB")
@@ -97,62 +337,147 @@ class NewsDB:
     def __maybeCommit(self):
         self.__trans += 1
         if self.__trans >= self.__TXN_SIZE:
-            self.__trans = 0
-            self.db.commit()
+            self.commit()
+
+    def commit(self):
+        """Commit whatever has been written so far."""
+        self.__trans = 0
+        self.db.commit()
 
     def setShouldMarkArticles(self, to):
         """Set to false if articles should not be marked in the news db."""
         self.__markArticles=to
 
-    def hasArticle(self, message_id):
+    def hasArticle(self, message_id, dest=''):
         """Return true if there is a reference to the given message ID in
-        this database.
+        this database for the given destination.
         """
         rv=False
         if self.__markArticles:
-            self.cur.execute(GET_ARTICLE, (message_id,))
+            if dest:
+                self.cur.execute(GET_DEST_ARTICLE, (dest, message_id))
+            else:
+                self.cur.execute(GET_ARTICLE, (message_id,))
             rv = len(self.cur.fetchall()) > 0
         return rv
 
-    def markArticle(self, message_id):
-        """Mark the article seen."""
+    def markArticle(self, message_id, dest=''):
+        """Mark the article seen by the given destination."""
         if self.__markArticles:
-            self.cur.execute(INS_ARTICLE, (message_id, datetime.datetime.now()))
+            now=datetime.datetime.now()
+            if dest:
+                self.cur.execute(INS_DEST_ARTICLE, (dest, message_id, now))
+            else:
+                self.cur.execute(INS_ARTICLE, (message_id, now))
             self.__maybeCommit()
 
-    def getLastId(self, group):
-        """Get the last seen article ID for the given group, or 0 if this
-        group hasn't been seen.
+    def getLastId(self, group, dest=''):
+        """Get the last seen article ID for the given group and destination,
+        or 0 if this group hasn't been seen.
         """
         rv=0
-        self.cur.execute(GET_GROUP, (group,))
+        if dest:
+            self.cur.execute(GET_DEST_GROUP, (dest, group))
+        else:
+            self.cur.execute(GET_GROUP, (group,))
+        rows = self.cur.fetchall()
+        if len(rows) > 0:
+            rv = int(rows[0][-1])
+        return rv
+
+    def setLastId(self, group, id, dest=''):
+        """Set the last seen article ID for the given group and
+        destination."""
+        if dest:
+            self.cur.execute(INS_DEST_GROUP, (dest, group, id))
+        else:
+            self.cur.execute(INS_GROUP, (group, id))
+        self.__maybeCommit()
+
+    def getRetries(self, now):
+        """Get the (dest, message ID, group, article number) of every
+        article due to be retried by the time now."""
+        self.cur.execute(GET_DUE_RETRIES, (now,))
+        return self.cur.fetchall()
+
+    def getRetryAttempts(self, message_id, dest=''):
+        """Get the number of times the article has been tried for the given
+        destination, or 0 if it's not waiting for a retry."""
+        rv=0
+        self.cur.execute(GET_RETRY, (dest, message_id))
         rows = self.cur.fetchall()
-        if len(rows) > 1:
-            rv = int(rows[0][1])
+        if len(rows) > 0:
+            rv = int(rows[0][0])
+        return rv
+
+    def setRetry(self, message_id, group, num, attempts, nextTry, dest=''):
+        """Record that the article should be retried for the given
+        destination no sooner than nextTry."""
+        self.cur.execute(INS_RETRY,
+            (dest, message_id, group, num, attempts, nextTry))
+        self.__maybeCommit()
+
+    def removeRetry(self, message_id, dest=''):
+        """Forget about retrying the article for the given destination."""
+        self.cur.execute(DEL_RETRY, (dest, message_id))
+        self.__maybeCommit()
+
+    def claimInFlight(self, keys, owner):
+        """Claim each of the (dest, message ID) keys for owner, returning a
+        dict of the ones no other owner already had in flight.
+
+        None of the keys should already belong to owner."""
+        self.cur.executemany(INS_INFLIGHT,
+            [(dest, message_id, owner) for dest, message_id in keys])
+        # Make the claims visible to everyone else right away.
+        self.commit()
+        self.cur.execute(GET_INFLIGHT, (owner,))
+        owned={}
+        for dest, message_id in self.cur.fetchall():
+            owned[(dest, message_id)]=1
+        rv={}
+        for key in keys:
+            if key in owned:
+                rv[key]=1
         return rv
 
-    def setLastId(self, group, id):
-        """Set the last seen article ID for the given group."""
-        self.cur.execute(INS_GROUP, (group, id))
+    def releaseInFlight(self, keys):
+        """Release (dest, message ID) keys claimed with claimInFlight."""
+        self.cur.executemany(DEL_INFLIGHT, keys)
         self.__maybeCommit()
 
+    def resetInFlight(self):
+        """Set up an empty in-flight table, forgetting anything left over
+        from a run that died."""
+        self.cur.executescript(RESETINFLIGHTSCRIPT)
+        self.db.commit()
+
+    def close(self):
+        """Commit any outstanding work and close the DB (safe to call more
+        than once).
+        """
+        if self.db is not None:
+            self.db.commit()
+            self.cur.close()
+            self.db.close()
+            self.db = None
+
     def __del__(self):
         """Close the DB on destruct."""
-        self.db.commit()
-        self.cur.close()
-        self.db.close()
+        self.close()
 
-    def getGroupRange(self, group, first, last, maxArticles=0):
+    def getGroupRange(self, group, first, last, maxArticles=0, dest=''):
         """Get the group range for the given group.
 
-        The arguments represent the group you're looking to copy, and the
-        first and last article numbers as provided by the news server.
+        The arguments represent the group you're looking to copy, the
+        first and last article numbers as provided by the news server, and
+        the destination it's being copied to.
 
         The first, last, and count that should be checked will be returned
         as a tuple."""
 
         # Start with myfirst being one greater than the last thing we've seen
-        myfirst=self.getLastId(group) + 1
+        myfirst=self.getLastId(group, dest) + 1
         first=int(first)
         last=int(last)
         self.log.debug("%s ranges from %d-%d, we want %d\n" \
@@ -178,6 +503,182 @@ class NewsDB:
 
 ######################################################################
 
+class TokenBucket:
+    """A token bucket refilling at rate tokens per second, holding no more
+    than a second's worth.  A rate of zero (or less) means unlimited."""
+
+    def __init__(self, rate=0):
+        self.lock=threading.Lock()
+        self.rate=rate
+        self.tokens=rate
+        self.stamp=time.time()
+
+    def setRate(self, rate):
+        """Change the rate at which tokens are added."""
+        if rate != self.rate:
+            self.lock.acquire()
+            try:
+                self.rate=rate
+                self.tokens=min(self.tokens, rate)
+            finally:
+                self.lock.release()
+
+    def take(self, n):
+        """Take n tokens, returning how many seconds the caller needs to
+        wait before using them."""
+        self.lock.acquire()
+        try:
+            if self.rate <= 0:
+                return 0
+            now=time.time()
+            self.tokens=min(self.rate,
+                self.tokens + ((now - self.stamp) * self.rate))
+            self.stamp=now
+            self.tokens-=n
+            rv=0
+            if self.tokens < 0:
+                rv=-self.tokens / float(self.rate)
+            return rv
+        finally:
+            self.lock.release()
+
+class Shaper:
+    """Keep traffic to a server under its configured rates.
+
+    The byte rate is shared by every connection to the server, while the
+    command rate applies to each connection (see newCommandBucket), since
+    that's how servers limit it.  The schedule is a list of (start, end,
+    bytesPerSecond, commandsPerSecond) tuples, with start and end in
+    minutes past midnight, overriding the default rates during that part
+    of the day."""
+
+    # How often (in seconds) we look at the schedule.
+    __CHECK_INTERVAL = 60
+
+    def __init__(self, bytesPerSecond=0, commandsPerSecond=0, schedule=[]):
+        self.log=logging.getLogger("Shaper")
+        self.bytesPerSecond=bytesPerSecond
+        self.commandsPerSecond=commandsPerSecond
+        self.schedule=schedule
+        self.bytes=TokenBucket()
+        self.commandRate=0
+        self.lock=threading.Lock()
+        self.waited=0.0
+        self.__checked=0
+        self.__checkSchedule()
+
+    def __checkSchedule(self):
+        now=time.time()
+        if now - self.__checked < self.__CHECK_INTERVAL:
+            return
+        self.__checked=now
+        t=time.localtime(now)
+        m=t.tm_hour * 60 + t.tm_min
+        b, c = self.bytesPerSecond, self.commandsPerSecond
+        for start, end, sb, sc in self.schedule:
+            if start <= end:
+                inWindow = start <= m < end
+            else:
+                # Wraps past midnight
+                inWindow = m >= start or m < end
+            if inWindow:
+                b, c = sb, sc
+                break
+        if b != self.bytes.rate or c != self.commandRate:
+            self.log.info("Shaping to %s bytes/s, %s commands/s" % (b, c))
+        self.bytes.setRate(b)
+        self.commandRate=c
+
+    def __wait(self, bucket, n):
+        self.__checkSchedule()
+        w=bucket.take(n)
+        if w > 0:
+            time.sleep(w)
+            self.lock.acquire()
+            try:
+                self.waited+=w
+            finally:
+                self.lock.release()
+
+    def newCommandBucket(self):
+        """Get a command bucket for a new connection."""
+        return TokenBucket()
+
+    def sendBytes(self, n):
+        """Wait until n more bytes may be moved."""
+        self.__wait(self.bytes, n)
+
+    def sendCommand(self, bucket):
+        """Wait until the connection owning bucket may send a command."""
+        bucket.setRate(self.commandRate)
+        self.__wait(bucket, 1)
+
+def parseSchedule(s, divisor=1):
+    """Parse a shaping schedule for Shaper.
+
+    The schedule is a comma separated list of entries that look like
+    ``HH:MM-HH:MM=bytesPerSecond/commandsPerSecond''.  Byte rates are
+    divided by divisor."""
+    rv=[]
+    for entry in s.split(','):
+        entry=entry.strip()
+        if entry == '':
+            continue
+        times, rates = entry.split('=')
+        start, end = [int(t.split(':')[0]) * 60 + int(t.split(':')[1])
+            for t in times.strip().split('-')]
+        b, c = [float(r) for r in rates.strip().split('/')]
+        rv.append((start, end, b / divisor, c))
+    return rv
+
+######################################################################
+
+class ServerInfo:
+    """What we know about a server, shared by every connection to it.
+
+    The mode is detected by the first connection to get there, and every
+    other connection just uses the answer.  No more than parallelism
+    connections to the server will be in the middle of connecting at
+    once.  If the server has a Shaper, all traffic to it goes through
+    that.
+
+    Connections give up on a server that takes longer than timeout seconds
+    to answer.  Once a server is marked down, nobody uses it until its
+    down time is over."""
+
+    def __init__(self, name, parallelism=4, shaper=None, timeout=None):
+        self.name=name
+        self.shaper=shaper
+        self.timeout=timeout
+        self.gate=threading.BoundedSemaphore(parallelism)
+        self.lock=threading.Lock()
+        self.mode=None
+        self.downUntil=0
+
+    def markDown(self, downTime):
+        """Keep everyone away from this server for downTime seconds."""
+        self.downUntil=time.time() + downTime
+
+    def isDown(self):
+        """Is this server marked down right now?"""
+        return time.time() < self.downUntil
+
+    def modeFor(self, conn):
+        """Get the mode of this server, detecting it with conn if nobody has
+        yet."""
+        self.lock.acquire()
+        try:
+            if self.mode is None:
+                self.mode=conn.checkMode()
+            return self.mode
+        finally:
+            self.lock.release()
+
+    def __repr__(self):
+        return "<ServerInfo: " + self.name + ">"
+
+######################################################################
+
 class NNTPClient(nntplib.NNTP):
     """An extension of nntplib.NNTP suitable for...well, it actually
     works."""
@@ -187,30 +688,97 @@ class NNTPClient(nntplib.NNTP):
         'Distribution', \
         'Lines', 'Content-Type', 'Content-Transfer-Encoding']
 
-    def __init__(self, host, port=119,user=None,password=None,readermode=None):
-        """See netlib.NNTP"""
+    def __init__(self, host, port=119,user=None,password=None,readermode=None,
+        server=None):
+        """See netlib.NNTP
+
+        server is the ServerInfo shared by all connections to this server."""
         self.log=logging.getLogger("NNTPClient")
-        self.log.info("Connecting to %s:%d" % (host, port))
-        nntplib.NNTP.__init__(self, host, port, user, password, readermode)
-        self.log.debug("Connected to %s:%d" % (host, port))
-        self.checkMode()
         self.host=host
         self.port=port
+        self.capabilities=None
+        if server is None:
+            server=ServerInfo(host)
+        self.server=server
+        self.shaper=server.shaper
+        if self.shaper is not None:
+            self.cmdBucket=self.shaper.newCommandBucket()
+        self.log.info("Connecting to %s:%d" % (host, port))
+        server.gate.acquire()
+        try:
+            nntplib.NNTP.__init__(self, host, port, user, password, readermode)
+        finally:
+            server.gate.release()
+        if server.timeout:
+            self.sock.settimeout(server.timeout)
+        self.log.debug("Connected to %s:%d" % (host, port))
+        self.currentmode=server.modeFor(self)
 
     def __repr__(self):
         return ("<NNTPClient: " + self.host + ":" + `self.port` + ">")
 
-    def checkMode(self):
-        """Upon construct, this tries to figure out whether the server
-        considers us a feeder or a reader."""
+    def putcmd(self, line):
+        """See nntplib.NNTP; waits on the shaper if there is one."""
+        if self.shaper is not None:
+            self.shaper.sendCommand(self.cmdBucket)
+        nntplib.NNTP.putcmd(self, line)
+
+    def putline(self, line):
+        """See nntplib.NNTP; waits on the shaper if there is one."""
+        if self.shaper is not None:
+            self.shaper.sendBytes(len(line) + 2)
+        nntplib.NNTP.putline(self, line)
+
+    def getline(self):
+        """See nntplib.NNTP; waits on the shaper if there is one."""
+        line=nntplib.NNTP.getline(self)
+        if self.shaper is not None:
+            self.shaper.sendBytes(len(line) + 2)
+        return line
+
+    def getCapabilities(self):
+        """Get the list of capability labels the server advertises, or None
+        if it doesn't understand CAPABILITIES."""
         try:
-            self.group('control')
-            self.currentmode='reader'
+            resp = self.shortcmd('CAPABILITIES')
         except nntplib.NNTPPermanentError:
-            self.currentmode='poster'
+            return None
         except nntplib.NNTPTemporaryError:
+            return None
+        if resp[:3] != '101':
+            return None
+        # nntplib doesn't know 101 is a multi-line response.
+        rv=[]
+        l=self.getline()
+        while l != '.':
+            if l.strip():
+                rv.append(l.split()[0].upper())
+            l=self.getline()
+        return rv
+
+    def checkMode(self):
+        """Figure out whether the server considers us a feeder or a reader.
+
+        The server's CAPABILITIES are used if it has them, otherwise we try
+        to select a group and see what happens."""
+        self.capabilities=self.getCapabilities()
+        caps=self.capabilities or []
+        if 'READER' in caps:
+            self.currentmode='reader'
+        elif 'IHAVE' in caps or 'MODE-READER' in caps:
+            # A transit server; we're not going to switch it to reader mode.
             self.currentmode='poster'
-        self.log.debug("Detected mode %s" % (self.currentmode))
+        else:
+            try:
+                self.group('control')
+                self.currentmode='reader'
+            except nntplib.NNTPPermanentError:
+                self.currentmode='poster'
+            except nntplib.NNTPTemporaryError:
+                self.currentmode='poster'
+        self.log.debug("Detected mode %s (capabilities:  %s)"
+            % (self.currentmode, self.capabilities))
+        return self.currentmode
 
     def __headerMatches(self, h):
         """Internal, checks to see if the header ``h'' is in our list of
@@ -231,26 +799,25 @@ class NNTPClient(nntplib.NNTP):
         resp = self.shortcmd('IHAVE ' + id)
         self.log.debug("IHAVE returned " + str(resp))
 
-    def copyArticle(self, src, which, messid):
-        """Copy an article from the src server to this server.
+    def copyArticle(self, article, messid):
+        """Copy an article to this server.
 
-        which is the ID of the message on the src server, messid is the
-        message ID of the article."""
-        self.log.debug("Moving " + str(which))
+        article is the Article to send, messid is its message ID."""
+        self.log.debug("Moving " + messid)
         if self.currentmode == 'reader':
-            resp, nr, id, lines = src.article(str(which))
-            self.post(lines)
+            self.post(article.lines())
         else:
             self.ihave(messid)
             try:
-                resp, nr, id, lines = src.article(messid)
+                lines = article.lines()
             except nntplib.NNTPTemporaryError, e:
                 # Generate an error, I don't HAVE this article, after all
                 self.log.warn("Did not have %s", messid)
                 try:
                     self.shortcmd('\r\n.')
-                except nntplib.NNTPTemporaryError, e:
-                    return
+                except nntplib.NNTPTemporaryError:
+                    pass
+                raise e
             self.takeThis(messid, lines)
 
     def takeThis(self, messid, lines):
@@ -289,12 +856,50 @@ class NNTPClient(nntplib.NNTP):
 
 ######################################################################
 
+class SourceError(Exception):
+    """Raised when the source connection broke while fetching an article, as
+    opposed to whichever destination was asking for it."""
+    pass
+
+class Article:
+    """An article on its way to one or more destinations.
+
+    The article is only fetched from the source the first time a
+    destination asks for it (so a destination that turns it down by IHAVE
+    costs nothing), and never more than once."""
+
+    def __init__(self, fetch):
+        self.__fetch=fetch
+        self.__lines=None
+        self.__error=None
+
+    def lines(self):
+        """Get the lines of the article."""
+        if self.__lines is None and self.__error is None:
+            try:
+                self.__lines=self.__fetch()
+            except nntplib.NNTPTemporaryError, e:
+                self.__error=e
+            except (socket.error, EOFError, nntplib.NNTPError), e:
+                raise SourceError(e)
+        if self.__error is not None:
+            raise self.__error
+        return self.__lines
+
 class Worker(threading.Thread):
+    """Copy articles from the source to each destination that wants them.
+
+    The destinations are delivered to one after another.  A destination
+    that breaks, or doesn't answer within its server's timeout, is marked
+    down for __DOWN_TIME seconds.  Every worker defers its articles for
+    retry in the meantime, so it can't hold up the rest for long."""
+
+    __DOWN_TIME = 60
 
-    def __init__(self, sf, df, inq, outq):
+    def __init__(self, sf, dfs, inq, outq):
         threading.Thread.__init__(self)
         self.srcf = sf
-        self.destf = df
+        self.destfs = dfs
         self.inq = inq
         self.outq = outq
         self.log=logging.getLogger("Worker")
@@ -306,85 +911,206 @@ class Worker(threading.Thread):
         self.start()
 
     def run(self):
+        self.src = None
+        self.dests = [None] * len(self.destfs)
         while self.running:
             try:
                 self.src = self.srcf()
-                self.dest = self.destf()
+                self.currentGroup = ""
                 self.mainLoop()
-            except nntplib.NNTPPermanentError, e:
-                traceback.print_exc()
-                try:
-                    self.src.quit()
-                except:
-                    pass
-                try:
-                    self.dest.quit()
-                except:
-                    pass
             except:
+                # Dying here would leave the queue never finishing, so drop
+                # the source connection and try again in a bit.
                 traceback.print_exc()
-                sys.exit(1)
+                if self.src is not None:
+                    try:
+                        self.src.quit()
+                    except:
+                        pass
+                    self.src = None
+                time.sleep(1)
+
+    def dropDestination(self, d, downTime=0):
+        """Throw away the connection to the d'th destination, and have
+        everyone stay away from it for downTime seconds."""
+        try:
+            self.dests[d].file.close()
+            self.dests[d].sock.close()
+        except:
+            pass
+        self.dests[d]=None
+        if downTime:
+            self.destfs[d].server.markDown(downTime)
+
+    def fetch(self, group, num):
+        """Fetch an article from the source."""
+        if group != self.currentGroup:
+            self.src.group(group)
+            self.currentGroup = group
+        resp, nr, id, lines = self.src.article(str(num))
+        return lines
+
+    def copyTo(self, d, article, messid):
+        """Copy the article to the d'th destination, returning how it
+        went:  success, duplicate, retry (worth trying again later), or
+        error."""
+        if self.destfs[d].server.isDown():
+            return 'retry'
+        if self.dests[d] is None:
+            try:
+                self.dests[d]=self.destfs[d]()
+            except (socket.error, EOFError, nntplib.NNTPError), e:
+                self.log.warn("Can't connect to " + self.destfs[d].server.name
+                    + ":  " + e.__class__.__name__ + " " + str(e))
+                self.dropDestination(d, self.__DOWN_TIME)
+                return 'retry'
+        rv='success'
+        try:
+            self.dests[d].copyArticle(article, messid)
+        except SourceError:
+            # We may have been in the middle of an IHAVE.
+            self.dropDestination(d)
+            raise
+        except nntplib.NNTPTemporaryError, e:
+            resp=str(e)
+            if resp[:3] == '435' or resp.find("Duplicate") >= 0:
+                rv='duplicate'
+            elif resp[:3] == '437':
+                # Rejected, it's not going to get any better.
+                rv='error'
+                self.log.warn("Rejected:  " + resp)
+            else:
+                # Deferred (436), missing from the source, or some other
+                # temporary failure.
+                rv='retry'
+                self.log.warn("Failed:  " + resp)
+        except (socket.error, EOFError, nntplib.NNTPError), e:
+            self.log.warn("Lost " + self.destfs[d].server.name + ":  "
+                + e.__class__.__name__ + " " + str(e))
+            self.dropDestination(d, self.__DOWN_TIME)
+            rv='retry'
+        return rv
 
     def mainLoop(self):
         while self.running:
-            group, num, messid = self.inq.get()
-            self.log.debug("doing %s, %s, %s", group, num, messid)
-            if group != self.currentGroup:
-                self.src.group(group)
-                self.currentGroup = group
+            group, num, messid, dests = self.inq.get()
+            self.log.debug("doing %s, %s, %s for %s",
+                group, num, messid, dests)
+            article=Article(lambda: self.fetch(group, num))
+            pending=list(dests)
             try:
-                self.dest.copyArticle(self.src, num, messid)
-                self.outq.put(('success', messid))
-            except nntplib.NNTPTemporaryError, e:
-                if str(e).find("Duplicate"):
-                    self.outq.put(('duplicate', messid))
-                else:
-                    self.outq.put(('error', messid))
-                    self.log.warn("Failed:  " + str(e))
-
-            self.inq.task_done()
+                try:
+                    while pending:
+                        d=pending[0]
+                        t=self.copyTo(d, article, messid)
+                        self.outq.put((t, group, num, messid, d, time.time()))
+                        pending.pop(0)
+                except:
+                    # Report the rest so they're released and retried, then
+                    # let run() deal with the connections.
+                    for d in pending:
+                        self.outq.put(('retry', group, num, messid, d,
+                            time.time()))
+                    raise
+            finally:
+                self.inq.task_done()
 
 class NNTPSucka:
     """Copy articles from one NNTP server to another."""
 
-    def __init__(self, srcf, destf, config):
-        """Get an NNTPSucka with two NNTPClient objects representing the
-        source and destination."""
+    def __init__(self, srcf, destfs, config, shard=0, shards=1):
+        """Get an NNTPSucka copying from the server made by srcf to the
+        servers made by each of destfs.
+
+        Each article is fetched once and delivered to every destination
+        that wants it.  The first destination is the primary one (see
+        NewsDB).  A destination that can't be reached is skipped for this
+        run and catches up next time.
+
+        When shards is greater than one, only groups belonging to the given
+        shard (see shardOf) will be copied."""
         self.log=logging.getLogger("NNTPSucka")
-        self.src=srcf()
-        self.dest=destf()
+        self.shard=shard
+        self.shards=shards
+
+        conns, errors = openConnections([srcf] + destfs)
+        if errors[0] is not None:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        self.src=conns[0]
+        self.dests=[]
+        self.destfs=[]
+        self.destKeys=[]
+        for i in range(len(destfs)):
+            if errors[i + 1] is None:
+                self.dests.append(conns[i + 1])
+                self.destfs.append(destfs[i])
+                self.destKeys.append(i and destfs[i].server.name or '')
+            else:
+                self.log.warn("Skipping " + destfs[i].server.name
+                    + " this time:  " + str(errors[i + 1][1]))
+        if not self.dests:
+            e=errors[1]
+            raise e[0], e[1], e[2]
 
         self.reqQueue = Queue.Queue(1000)
-        self.doneQueue = Queue.Queue(1000)
+        # Unbounded so workers never block reporting while we're blocked
+        # queueing.
+        self.doneQueue = Queue.Queue()
+        # (dest, message ID) of everything queued from the retries table
+        self.retrying = {}
+        # (dest, message ID) of everything deferred or given up on this run
+        self.deferred = {}
+
+        # How many times to try an article and how long to wait after the
+        # first failure (doubling each time after that).
+        self.retryAttempts=config.getint("misc", "retryAttempts")
+        self.retryBackoff=config.getint("misc", "retryBackoff")
 
         # Figure out the maximum number of articles per group
         self.maxArticles=config.getint("misc", "maxArticles")
         self.log.debug("Max articles is configured as %d" %(self.maxArticles))
 
         # NewsDB setup
-        self.db=NewsDB(config.get("misc","newsdb"))
+        self.db=NewsDB(config.get("misc","newsdb"), shared=shards > 1)
         self.db.setShouldMarkArticles(config.getboolean("misc",
             "shouldMarkArticles"))
 
+        # Where to pick up each group next time
+        self.progress = Progress()
+
+        # Shards have to share the in-flight registry through the DB.
+        if shards > 1:
+            self.inflight = InFlight(self.db)
+        else:
+            self.inflight = InFlight()
+
         # Initialize stats
         self.stats=Stats()
 
-        self.workers = [Worker(srcf, destf, self.reqQueue, self.doneQueue)
+        self.workers = [Worker(srcf, self.destfs, self.reqQueue,
+                               self.doneQueue)
                         for x in range(config.getint("misc", "workers"))]
 
-    def copyGroup(self, groupname):
-        """Copy the given group from the source server to the destination
-        server.
+    def copyGroup(self, groupname, dests=[0]):
+        """Copy the given group from the source server to the given
+        destination servers (indexes into self.dests).
 
         Efforts are made to ensure only articles that haven't been seen are
         copied."""
         self.log.debug("Getting group " + groupname + " from " + `self.src`)
+        self.db.commit()
         resp, count, first, last, name = self.src.group(groupname)
         self.log.debug("Done getting group")
 
-        # Figure out where we are
-        myfirst, mylast, mycount= self.db.getGroupRange(groupname, first, last,
-            self.maxArticles)
+        # Figure out where each destination is, and cover all of them.
+        firsts={}
+        mycount=0
+        for d in dests:
+            dfirst, mylast, dcount = self.db.getGroupRange(groupname,
+                first, last, self.maxArticles, self.destKeys[d])
+            firsts[d]=dfirst
+            mycount=max(mycount, dcount)
+        myfirst=min(firsts.values())
         l=[]
         if mycount > 0:
             self.log.info("Copying " + `mycount` + " articles:  " \
@@ -398,21 +1124,10 @@ class NNTPSucka:
                 self.log.warn("Unexpected number of articles returned.  " \
                     + "Expected " + `mycount` + ", but got " + `len(l)`)
 
-        # Flip through the stuff we actually want to process.
+        # Figure out which destinations want what...
+        articles=[]
+        keys=[]
         for i in l:
-            try:
-                t,  messid = self.doneQueue.get_nowait()
-                if t == 'success':
-                    self.log.debug("Finished %s", messid)
-                    self.db.markArticle(messid)
-                    self.stats.addMoved()
-                elif t == 'duplicate':
-                    self.db.markArticle(messid)
-                    self.stats.addDup()
-                else:
-                    self.stats.addOther()
-            except Queue.Empty:
-                pass
             try:
                 messid="*empty*"
                 messid=i[1]
@@ -420,46 +1135,205 @@ class NNTPSucka:
                 self.log.debug("idx is " + idx + " range is " + `myfirst` \
                     + "-" + `mylast`)
                 assert(int(idx) >= myfirst and int(idx) <= mylast)
-                if self.db.hasArticle(messid):
-                    self.log.info("Already seen " + messid)
-                    self.stats.addDup()
-                else:
-                    self.reqQueue.put((groupname, idx, messid))
-                # Mark this message as having been read in the group
-                self.db.setLastId(groupname, idx)
+                want=[]
+                seen=0
+                for d in dests:
+                    key=self.destKeys[d]
+                    if int(idx) < firsts[d]:
+                        # This destination was already past here.
+                        continue
+                    if self.db.hasArticle(messid, key):
+                        seen+=1
+                    elif (key, messid) in self.deferred \
+                        or self.db.getRetryAttempts(messid, key):
+                        # Crossposted, and the retries will take care of it.
+                        pass
+                    else:
+                        want.append(d)
+                        keys.append((key, messid))
+                    self.progress.scanned(groupname, key, int(idx))
+                articles.append((idx, messid, want, seen))
             except KeyError, e:
                 # Couldn't find the header, article probably doesn't
                 # exist anymore.
                 pass
 
+        # ...claim it all at once, and flip through what we got.
+        claimed=self.inflight.claimAll(keys)
+        for idx, messid, want, seen in articles:
+            self.processDone()
+            wanted=[d for d in want
+                if claimed.pop((self.destKeys[d], messid), None)]
+            if wanted:
+                for d in wanted:
+                    self.progress.add(groupname, self.destKeys[d], int(idx))
+                self.queueRequest((groupname, idx, messid, wanted))
+            elif want:
+                self.log.info("Already in flight " + messid)
+                self.stats.addCrosspost()
+            elif seen:
+                self.log.info("Already seen " + messid)
+                self.stats.addDup()
+
+        # Mark what's been read in the group (as far as nothing's pending)
+        for d in dests:
+            self.saveProgress(groupname, self.destKeys[d])
+
+    def saveProgress(self, group, key):
+        """Record the last seen ID for the group and destination, if it's
+        moved on."""
+        id=self.progress.lastId(group, key)
+        if id is not None:
+            self.db.setLastId(group, id, key)
+
+    def queueRequest(self, req):
+        """Hand a request to the workers, committing first if we're going to
+        have to wait for room (so other shards can get at the DB)."""
+        try:
+            self.reqQueue.put_nowait(req)
+        except Queue.Full:
+            self.db.commit()
+            self.reqQueue.put(req)
+
+    def processDone(self):
+        """Record everything the workers have finished so far."""
+        released=[]
+        while True:
+            try:
+                t, group, num, messid, d, when = self.doneQueue.get_nowait()
+            except Queue.Empty:
+                break
+            key=self.destKeys[d]
+            retried=self.retrying.pop((key, messid), None)
+            if t == 'retry':
+                self.deferArticle(group, num, messid, key)
+            else:
+                if retried:
+                    self.db.removeRetry(messid, key)
+                if t == 'success':
+                    self.log.debug("Finished %s for %s",
+                        messid, self.dests[d])
+                    self.db.markArticle(messid, key)
+                    self.stats.addMoved(when)
+                    if retried:
+                        self.stats.addRecovered()
+                elif t == 'duplicate':
+                    self.db.markArticle(messid, key)
+                    self.stats.addDup()
+                else:
+                    self.stats.addOther()
+            # A deferred article is in the retries table now, so that
+            # counts as done too.
+            if not retried:
+                self.progress.finish(group, key, int(num))
+                self.saveProgress(group, key)
+            released.append((key, messid))
+        # Only release once they're marked, so nothing can sneak past both.
+        self.inflight.releaseAll(released)
+
+    def deferArticle(self, group, num, messid, key):
+        """Put off an article that couldn't be copied to the given
+        destination until a later run, or give up on it if it's been tried
+        too many times.
+
+        Each article only counts one attempt per run."""
+        if (key, messid) in self.deferred:
+            return
+        self.deferred[(key, messid)]=1
+        attempts=self.db.getRetryAttempts(messid, key) + 1
+        if attempts >= self.retryAttempts:
+            self.log.warn("Giving up on %s after %d attempts"
+                % (messid, attempts))
+            self.db.removeRetry(messid, key)
+            self.stats.addAbandoned()
+        else:
+            nextTry=time.time() + (self.retryBackoff * 2 ** (attempts - 1))
+            self.db.setRetry(messid, group, num, attempts, nextTry, key)
+            self.stats.addDeferred()
+
+    def retryDeferred(self, ignorelist):
+        """Queue up the deferred articles that are due for another try."""
+        dests={}
+        for d in range(len(self.destKeys)):
+            dests[self.destKeys[d]]=d
+        due=[]
+        for key, messid, group, num in self.db.getRetries(time.time()):
+            if key not in dests or not self.shouldProcess(group, ignorelist):
+                continue
+            if self.db.hasArticle(messid, key):
+                self.db.removeRetry(messid, key)
+            else:
+                due.append((key, messid, group, num))
+        claimed=self.inflight.claimAll([(key, messid)
+            for key, messid, group, num in due])
+        # Gather them by article so each is only fetched once.
+        articles=[]
+        wanted={}
+        for key, messid, group, num in due:
+            if claimed.pop((key, messid), None):
+                self.retrying[(key, messid)]=1
+                a=(group, num, messid)
+                if a not in wanted:
+                    articles.append(a)
+                    wanted[a]=[]
+                wanted[a].append(dests[key])
+        if articles:
+            self.log.info("Retrying " + `len(articles)` + " articles")
+        for a in articles:
+            self.processDone()
+            group, num, messid = a
+            self.queueRequest((group, num, messid, wanted[a]))
+
     def shouldProcess(self, group, ignorelist):
-        rv = True
+        rv = shardOf(group, self.shards) == self.shard
         for i in ignorelist:
             if i.match(group) is not None:
                 rv = False
         return rv
 
     def copyServer(self, ignorelist=[]):
-        """Copy all groups that appear on the destination server to the
-        destination server from the source server."""
-        self.log.debug("Getting list of groups from " + `self.dest`)
-        resp, list = self.dest.list()
-        self.log.debug("Done getting list of groups from destination")
-        for l in list:
-            group=l[0]
+        """Copy all groups that appear on the destination servers to each
+        destination server carrying them from the source server."""
+        groups=[]
+        carriers={}
+        for d in range(len(self.dests)):
+            self.log.debug("Getting list of groups from " + `self.dests[d]`)
+            resp, list = self.dests[d].list()
+            self.log.debug("Done getting list of groups from destination")
+            for l in list:
+                group=l[0]
+                if group not in carriers:
+                    groups.append(group)
+                    carriers[group]=[]
+                carriers[group].append(d)
+        self.retryDeferred(ignorelist)
+        for group in groups:
             if self.shouldProcess(group, ignorelist):
                 try:
                     self.log.debug("copying " + `group`)
-                    self.copyGroup(group)
+                    self.copyGroup(group, carriers[group])
                 except nntplib.NNTPTemporaryError, e:
                     self.log.warn("Error on group " + group + ":  " + str(e))
+                except sqlite.OperationalError, e:
+                    # Most likely another shard held the DB for too long.
+                    self.log.warn("DB error on group " + group + ":  "
+                        + str(e))
 
+        self.db.commit()
         self.reqQueue.join()
+        try:
+            self.processDone()
+        except sqlite.OperationalError, e:
+            self.log.warn("DB error recording results:  " + str(e))
 
     def getStats(self):
         """Get the statistics object."""
         return self.stats
 
+    def close(self):
+        """Flush and close the news DB."""
+        self.db.close()
+
 class OptConf(ConfigParser.ConfigParser):
     """ConfigParser with get that supports default values"""
 
@@ -488,6 +1362,35 @@ def alarmHandler(sig, frame):
     """Do nothing but raise a timeout."""
     raise Timeout
 
+def openConnections(factories):
+    """Open a connection from each of the given factories concurrently.
+
+    Returns a list of the connections and a list of the exc_info for the
+    ones that failed (None for the ones that didn't), in the same order as
+    the factories."""
+    rv=[None] * len(factories)
+    errors=[None] * len(factories)
+    def opener(i, f):
+        try:
+            rv[i]=f()
+        except:
+            errors[i]=sys.exc_info()
+    threads=[threading.Thread(target=opener, args=(i, f), name="opener")
+        for i, f in enumerate(factories)]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        # Join with a timeout so the startup alarm can still get through.
+        while t.isAlive():
+            t.join(1)
+    return rv, errors
+
+def shardOf(group, shards):
+    """Deterministically pick the shard (0 through shards-1) that owns the
+    given group."""
+    return (zlib.crc32(group) & 0xffffffff) % shards
+
 def getIgnoreList(fn):
     log=logging.getLogger("nntpsucka")
     log.debug("Getting ignore list from " + fn)
@@ -498,24 +1401,135 @@ def getIgnoreList(fn):
         rv.append(re.compile(l))
     return rv
 
-def connectionMaker(conf, which):
+def connectionMaker(conf, which, shards=1):
+    """Get a function that makes new connections to the given server."""
+    return serverConnectionMaker(conf, conf.get("servers", which), shards)
+
+def connectionMakers(conf, which, shards=1):
+    """Get a connection function for each of the (comma separated) servers
+    listed for the given server."""
+    return [serverConnectionMaker(conf, s.strip(), shards)
+        for s in conf.get("servers", which).split(',') if s.strip()]
+
+def serverConnectionMaker(conf, connServer, shards=1):
+    """Get a function that makes new connections to the named server.
+
+    Shaping rates are divided among the shards, since each shard process
+    shapes its own traffic."""
 
-    connServer=conf.get("servers", which)
     connUser=None
     connPass=None
     connPort=119
+    connParallel=4
+    connTimeout=60
+    shaper=None
     num_conn = 1
     if conf.has_section(connServer):
         connUser=conf.getWithDefault(connServer, "username", None)
         connPass=conf.getWithDefault(connServer, "password", None)
         connPort=conf.getint(connServer, "port")
+        connParallel=conf.getint(connServer, "connectParallelism")
+        connTimeout=conf.getfloat(connServer, "timeout")
+        bytesPerSecond=conf.getfloat(connServer, "bytesPerSecond") / shards
+        commandsPerSecond=conf.getfloat(connServer, "commandsPerSecond")
+        schedule=parseSchedule(conf.getWithDefault(connServer,
+            "shapingSchedule", ""), shards)
+        if bytesPerSecond > 0 or commandsPerSecond > 0 or schedule:
+            shaper=Shaper(bytesPerSecond, commandsPerSecond, schedule)
+
+    server=ServerInfo(connServer, connParallel, shaper, connTimeout)
 
     def f():
         return NNTPClient(connServer, port=connPort,
-                          user=connUser, password=connPass)
+                          user=connUser, password=connPass, server=server)
 
+    f.server=server
     return f
 
+def runSucka(conf, ign, shard=0, shards=1):
+    """Copy everything in the given shard, returning the NNTPSucka that did
+    the work."""
+    fromFactory = connectionMaker(conf, "from", shards)
+    toFactories = connectionMakers(conf, "to", shards)
+
+    signal.alarm(STARTUP_TIMEOUT)
+    sucka=NNTPSucka(fromFactory, toFactories, config=conf,
+        shard=shard, shards=shards)
+    signal.alarm(TIMEOUT)
+    sucka.copyServer(ign)
+    signal.alarm(0)
+    for f in [fromFactory] + toFactories:
+        if f.server.shaper is not None:
+            sucka.getStats().addShaperWait(f.server.name,
+                f.server.shaper.waited)
+    sucka.close()
+    return sucka
+
+def runShard(conf, ign, shard, shards, fd):
+    """Body of a shard process.  The stats are pickled to fd when done.
+
+    Returns the exit status for the process."""
+    log=logging.getLogger("nntpsucka")
+    rv=1
+    lock=pidlock.PidLock(conf.get("misc", "pidfile") + "." + `shard`)
+    try:
+        try:
+            log.info("Shard %d of %d starting in pid %d"
+                % (shard, shards, os.getpid()))
+            sucka=runSucka(conf, ign, shard, shards)
+            f=os.fdopen(fd, "w")
+            cPickle.dump(sucka.getStats(), f, cPickle.HIGHEST_PROTOCOL)
+            f.close()
+            rv=0
+        except Timeout:
+            sys.stderr.write("Shard " + `shard` + " took too long.\n")
+        except:
+            traceback.print_exc()
+    finally:
+        lock.unlock()
+    return rv
+
+def runSharded(conf, ign, shards):
+    """Fork one process per shard and return the merged stats."""
+    log=logging.getLogger("nntpsucka")
+
+    # Get the schema and the WAL journal in place before the children race
+    # for it, and clear out anything a previous run left in flight.
+    db=NewsDB(conf.get("misc", "newsdb"), shared=True)
+    db.resetInFlight()
+    db.close()
+
+    children=[]
+    for shard in range(shards):
+        r, w = os.pipe()
+        pid=os.fork()
+        if pid == 0:
+            rv=1
+            try:
+                os.close(r)
+                rv=runShard(conf, ign, shard, shards, w)
+            finally:
+                # Don't let the child wander back into the supervisor.
+                os._exit(rv)
+        os.close(w)
+        children.append((shard, pid, r))
+
+    stats=Stats()
+    for shard, pid, r in children:
+        f=os.fdopen(r)
+        data=f.read()
+        f.close()
+        pid, status = os.waitpid(pid, 0)
+        if data:
+            stats.merge(cPickle.loads(data))
+        if os.WIFSIGNALED(status):
+            log.warn("Shard %d (pid %d) was killed by signal %d"
+                % (shard, pid, os.WTERMSIG(status)))
+        elif os.WEXITSTATUS(status) != 0:
+            log.warn("Shard %d (pid %d) exited with status %d"
+                % (shard, pid, os.WEXITSTATUS(status)))
+    return stats
+
 def main():
     conf=OptConf(CONF_DEFAULTS, CONF_SECTIONS)
     conf.read(sys.argv[1])
@@ -523,11 +1537,8 @@ def main():
     # Lock to make sure only one is running at a time.
     lock=pidlock.PidLock(conf.get("misc", "pidfile"))
 
-    # How long do we wait for startup?
     signal.signal(signal.SIGALRM, alarmHandler)
-    signal.alarm(30)
-    # And how long will we wait for the actual processing?
-    TIMEOUT = 4 * 3600
+    signal.alarm(STARTUP_TIMEOUT)
 
     # Validate there's a config file
     if len(sys.argv) < 2:
@@ -538,31 +1549,37 @@ def main():
     logging.config.fileConfig(sys.argv[1])
 
     filterList=conf.getWithDefault("misc", "filterList", None)
+    processes=conf.getint("misc", "processes")
 
-    fromFactory = connectionMaker(conf, "from")
-    toFactory = connectionMaker(conf, "to")
-
-    sucka=None
+    stats=None
     # Mark the start time
     start=time.time()
     try:
         ign=[re.compile('^control\.')]
         if filterList is not None:
             ign=getIgnoreList(filterList)
-        signal.alarm(30)
-        sucka=NNTPSucka(fromFactory, toFactory, config=conf)
-        signal.alarm(TIMEOUT)
-        sucka.copyServer(ign)
+        if processes > 1:
+            signal.alarm(0)
+            stats=runSharded(conf, ign, processes)
+        else:
+            stats=runSucka(conf, ign).getStats()
     except Timeout:
         sys.stderr.write("Took too long.\n")
         sys.exit(1)
     # Mark the stop time
     stop=time.time()
 
-    if sucka:
+    if stats:
         # Log the stats
         log=logging.getLogger("nntpsucka")
-        log.info(sucka.getStats())
+        log.info(stats)
+        log.info(stats.retryString())
+        if stats.firstMoved is not None:
+            log.info("Time to first transfer:  "
+                + str(stats.firstMoved-start) + "s")
+        for server, secs in sorted(stats.shaperWait.items()):
+            log.info("Time waiting on " + server + " shaper:  "
+                + str(secs) + "s")
         log.info("Total time spent:  " + str(stop-start) + "s")
 
 if __name__ == '__main__':